@@ -1,13 +1,22 @@
+from itertools import islice
+
 from qgis.core import QgsProject
-from qgis.PyQt.QtCore import QObject
+from qgis.PyQt.QtCore import QObject, QTimer
 
 
 class LayerConnector(QObject):
     """Generic class to connect to all layers in the project"""
 
+    # Maximum number of layers connected per event loop iteration
+    CONNECT_BATCH_SIZE = 32
+
     def __init__(self, delay_connect=False):
         super().__init__()
         self.attached = False
+        # Ids of the layers waiting to be connected (ordered) -> whether the layer was added to the project,
+        # as opposed to already being in the project when attaching
+        self._pending_connects = {}
+        self._drain_scheduled = False
 
         if not delay_connect:
             self.attach()
@@ -18,8 +27,9 @@ class LayerConnector(QObject):
 
     def attach(self):
         # Whenever a layer is added to the project, connect to it
-        QgsProject.instance().layerWasAdded.connect(self.connect_layer)
-        QgsProject.instance().layersWillBeRemoved.connect(self.disconnect_layers)
+        proj = QgsProject.instance()
+        proj.layerWasAdded.connect(self.queue_layer)
+        proj.layersWillBeRemoved.connect(self.disconnect_layers)
         # Connect to all layers already in the project
         self.connect_layers()
         self.attached = True
@@ -32,30 +42,69 @@ class LayerConnector(QObject):
             return
 
         # Disconnect the signal
-        QgsProject.instance().layerWasAdded.disconnect(self.connect_layer)
-        QgsProject.instance().layersWillBeRemoved.disconnect(self.disconnect_layers)
+        proj = QgsProject.instance()
+        proj.layerWasAdded.disconnect(self.queue_layer)
+        proj.layersWillBeRemoved.disconnect(self.disconnect_layers)
 
-        # Disconnect from all layers
+        # Drop the layers not connected yet and disconnect from the others
         self.disconnect_layers()
         self.attached = False
 
+    def queue_layer(self, layer, added=True):
+        """Schedule the connection to a layer once the event loop is idle"""
+        self._pending_connects[layer.id()] = added
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            QTimer.singleShot(0, self._drain_pending)
+
+    def _drain_pending(self):
+        """Connect to the next batch of pending layers, then re-arm if some are left"""
+        self._drain_scheduled = False
+        batch = dict(islice(self._pending_connects.items(), self.CONNECT_BATCH_SIZE))
+        for layer_id in batch:
+            del self._pending_connects[layer_id]
+        self._connect_layer_ids(batch)
+        if self._pending_connects:
+            self._drain_scheduled = True
+            QTimer.singleShot(0, self._drain_pending)
+
+    def flush_pending_connects(self):
+        """Synchronously connect to all the pending layers"""
+        pending = self._pending_connects
+        self._pending_connects = {}
+        self._connect_layer_ids(pending)
+
+    def _connect_layer_ids(self, pending):
+        proj = QgsProject.instance()
+        for layer_id, added in pending.items():
+            # The layer may have been removed from the project in the meantime
+            layer = proj.mapLayer(layer_id)
+            if layer is not None:
+                self.connect_layer(layer, added)
+
     def connect_layers(self):
         """Connect to all the layers already in the project"""
         for layer in QgsProject.instance().mapLayers().values():
-            self.connect_layer(layer)
+            self.queue_layer(layer, added=False)
 
     def disconnect_layers(self, layer_ids=None):
         """Disconnect from all the layers already in the project"""
 
+        proj = QgsProject.instance()
         if not layer_ids:
-            for layer in QgsProject.instance().mapLayers().values():
+            self._pending_connects.clear()
+            for layer in proj.mapLayers().values():
                 self.disconnect_layer(layer)
         else:
             for layer_id in layer_ids:
-                self.disconnect_layer(QgsProject.instance().mapLayers().get(layer_id))
+                self._pending_connects.pop(layer_id, None)
+                self.disconnect_layer(proj.mapLayer(layer_id))
 
-    def connect_layer(self, layer):
-        """This method should be overridden by the child class"""
+    def connect_layer(self, layer, added=True):
+        """This method should be overridden by the child class
+
+        added is False for the layers already in the project when attaching.
+        """
         pass
 
     def disconnect_layer(self, layer):
@@ -1,9 +1,10 @@
 import configparser
 import sys
+from os.path import exists
 from pathlib import Path
 
 from qgis.core import QgsApplication, QgsProject
-from qgis.PyQt.QtCore import QFile
+from qgis.PyQt.QtCore import QBuffer, Qt
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QMessageBox, QStyle, QWidget
 from qgis.utils import iface
@@ -14,15 +15,44 @@ from .reader import Reader
 from .settings import Settings
 from .settings_dialog import SettingsDialog
 from .toolbox import log
-from .writer import Writer
+from .writer import FlushWorker, Writer
+
+# Name of the mldata file in the project attachments
+MLDATA_ATTACHMENT = "layers.mldata"
 
 
 class MemoryLayerSaver(LayerConnector):
+    # Layer signals that mark the project as dirty when a saved layer is modified
+    # (afterCommitChanges would be a single signal, but it requires QGIS 3.4)
+    _DIRTY_SIGNALS = (
+        "committedAttributesDeleted",
+        "committedAttributesAdded",
+        "committedFeaturesRemoved",
+        "committedFeaturesAdded",
+        "committedAttributeValuesChanges",
+        "committedGeometriesChanges",
+    )
+
     def __init__(self):
+        # Ids of the layers whose signals are connected
+        self._connected_layers = set()
+        # Path of the mldata file in the project attachments, once found
+        self._cached_mldata_path = None
+        # Plugin metadata, displayed in the about message box
+        cfg = configparser.ConfigParser()
+        cfg.read(Path(__file__).parent / "metadata.txt")
+        self._meta = {key: cfg.get("general", key) for key in ("name", "version", "repository", "tracker", "homepage")}
         super().__init__()
+        # Writes the legacy .mldata files without blocking the GUI
+        self._flush_worker = FlushWorker(self)
+        self._flush_worker.failed.connect(self.on_flush_failed, Qt.ConnectionType.QueuedConnection)
         proj = QgsProject.instance()
         self.has_modified_layers = proj.isDirty()
 
+        # Must be connected before load_data so the cache is cleared before reading
+        proj.readProject.connect(self.clear_mldata_path_cache)
+        proj.projectSaved.connect(self.clear_mldata_path_cache)
+        proj.cleared.connect(self.clear_mldata_path_cache)
         proj.readProject.connect(self.load_data)
         proj.writeProject.connect(self.save_data)
         proj.cleared.connect(self.on_cleared)
@@ -63,8 +93,13 @@ class MemoryLayerSaver(LayerConnector):
         iface.pluginMenu().removeAction(self.menu.menuAction())
         self.detach()
         proj = QgsProject.instance()
+        proj.readProject.disconnect(self.clear_mldata_path_cache)
+        proj.projectSaved.disconnect(self.clear_mldata_path_cache)
+        proj.cleared.disconnect(self.clear_mldata_path_cache)
         proj.readProject.disconnect(self.load_data)
         proj.writeProject.disconnect(self.save_data)
+        proj.cleared.disconnect(self.on_cleared)
+        self._flush_worker.stop()
 
         # Restore the original value of the setting
         Settings.set_ask_to_save_memory_layers(Settings.backup_ask_to_save_memory_layers())
@@ -74,42 +109,50 @@ class MemoryLayerSaver(LayerConnector):
         """Called when the project is cleared (new project)"""
         self.has_modified_layers = False
 
-    def connect_layer(self, layer):
+    def connect_layer(self, layer, added=True):
+        # Avoid connecting the same layer twice (e.g. queued on attach and re-added)
+        if layer.id() in self._connected_layers:
+            return
         if Settings.is_saved_layer(layer):
-            layer.committedAttributesDeleted.connect(self.set_project_dirty)
-            layer.committedAttributesAdded.connect(self.set_project_dirty)
-            layer.committedFeaturesRemoved.connect(self.set_project_dirty)
-            layer.committedFeaturesAdded.connect(self.set_project_dirty)
-            layer.committedAttributeValuesChanges.connect(self.set_project_dirty)
-            layer.committedGeometriesChanges.connect(self.set_project_dirty)
+            self._connected_layers.add(layer.id())
+            slot = self.set_project_dirty
+            for signal in self._DIRTY_SIGNALS:
+                getattr(layer, signal).connect(slot)
             layer.dataSourceChanged.connect(self.on_data_source_changed)
-            # Connect layer will be called when a layer is added to the project
-            # So we set the has_modified_layers flag to ensure the mldata file will be
-            # updated when the project is saved
-            self.has_modified_layers = True
+            # When a layer is added to the project, we set the has_modified_layers flag
+            # to ensure the mldata file will be updated when the project is saved
+            # (layers already in the project when the plugin is loaded are left as is)
+            if added:
+                self.has_modified_layers = True
 
     def disconnect_layer(self, layer):
         try:
-            layer.committedAttributesDeleted.disconnect(self.set_project_dirty)
-            layer.committedAttributesAdded.disconnect(self.set_project_dirty)
-            layer.committedFeaturesRemoved.disconnect(self.set_project_dirty)
-            layer.committedFeaturesAdded.disconnect(self.set_project_dirty)
-            layer.committedAttributeValuesChanges.disconnect(self.set_project_dirty)
-            layer.committedGeometriesChanges.disconnect(self.set_project_dirty)
+            self._connected_layers.remove(layer.id())
+            slot = self.set_project_dirty
+            for signal in self._DIRTY_SIGNALS:
+                getattr(layer, signal).disconnect(slot)
             layer.dataSourceChanged.disconnect(self.on_data_source_changed)
             # Disconnect layer will be called when a layer is removed from the project
             # So we set the has_modified_layers flag to ensure the mldata file will be
             # updated when the project is saved
             self.has_modified_layers = True
-        except (AttributeError, TypeError):  # layer was not previously connected
+        except (AttributeError, KeyError, TypeError):  # layer was not previously connected
             pass
 
     def load_data(self):
         """Load the memory layers from the .mldata file"""
+        # Layers added while reading the project must be connected before the
+        # has_modified_layers flag is reset
+        self.flush_pending_connects()
+        self.has_modified_layers = False
+        if not QgsProject.instance().fileName():
+            return
+
+        # A previous save of the .mldata file may still be in progress
+        self._flush_worker.wait()
         filepath = self.memory_layer_file()
-        file = QFile(filepath)
-        if file.exists():
-            layers = list(self.memory_layers())
+        if filepath and exists(filepath):
+            layers = self.memory_layers()
             log(f"Loading memory layers from {filepath} ({len(layers)} layers)")
             if layers:
                 try:
@@ -120,32 +163,60 @@ class MemoryLayerSaver(LayerConnector):
                         iface.mainWindow(), self.tr("Error reloading memory layers"), str(sys.exc_info()[1])
                     )
 
-        self.has_modified_layers = False
-
     def save_data(self):
         """Write the layers to the .mldata file"""
+        # Layers not connected yet may not have flagged the project as modified
+        self.flush_pending_connects()
+
+        proj = QgsProject.instance()
+        if not proj.fileName():
+            return
 
         # Check if the mldata file exists and if any memory layer has been modified
         filepath = self.memory_layer_file(fallback_to_legacy=False)
-        if filepath and Path(filepath).exists() and not self.has_modified_layers:
+        if filepath and exists(filepath) and not self.has_modified_layers:
+            return
+
+        # Nothing to write, do not create an empty mldata file
+        layers = self.memory_layers()
+        if not layers:
+            self.has_modified_layers = False
             return
 
         # If mldata file do not exist in the attached files, create it
         if not Settings.legacy_mode() and not filepath:
-            QgsProject.instance().createAttachedFile("layers.mldata")
+            self._cached_mldata_path = proj.createAttachedFile(MLDATA_ATTACHMENT)
 
         filepath = self.memory_layer_file()
-        layers = list(self.memory_layers())
         log(f"Saving memory layers to {filepath} ({len(layers)} layers)")
-        if layers:
-            with Writer(filepath) as writer:
-                writer.write_layers(layers)
+        # Serialize the layers in memory, then write the file in one go
+        # Legacy mode is meant to be opened by older QGIS versions, whose plugin
+        # only reads version 2 of the format
+        legacy_mode = Settings.legacy_mode()
+        buffer = QBuffer()
+        with Writer(buffer, version=2 if legacy_mode else 3) as writer:
+            writer.write_layers(layers)
+        if legacy_mode:
+            # The separate .mldata file is written in the background
+            self._flush_worker.submit(filepath, buffer.data())
+        else:
+            # The attached file is zipped in the project right after writeProject,
+            # so it must be written synchronously
+            Writer.write_file(filepath, buffer.data())
 
         self.has_modified_layers = False
 
+    def on_flush_failed(self, filepath, error):
+        """Called when the background write of the .mldata file failed"""
+        # The layers have not been saved, make sure they will be written on next save
+        self.has_modified_layers = True
+        QgsProject.instance().setDirty(True)
+        QMessageBox.warning(iface.mainWindow(), self.tr("Error saving memory layers"), error)
+
     def memory_layers(self):
         """Return a list of all memory layers in the project"""
-        return [layer for layer in QgsProject.instance().mapLayers().values() if Settings.is_saved_layer(layer)]
+        is_saved_layer = Settings.is_saved_layer
+        return [layer for layer in QgsProject.instance().mapLayers().values() if is_saved_layer(layer)]
 
     def legacy_memory_layer_file(self):
         """Returns the path to the legacy .mldata file"""
@@ -153,7 +224,8 @@ class MemoryLayerSaver(LayerConnector):
 
     def memory_layer_file(self, fallback_to_legacy=True):
         """Returns the path to the .mldata file"""
-        name = QgsProject.instance().fileName()
+        proj = QgsProject.instance()
+        name = proj.fileName()
         if not name:
             return ""
 
@@ -161,20 +233,31 @@ class MemoryLayerSaver(LayerConnector):
         if Settings.legacy_mode():
             return self.legacy_memory_layer_file()
 
+        if self._cached_mldata_path:
+            return self._cached_mldata_path
+
         # Find the layers.mldata file in the attached files
         # Note attached files are prefixed with a random string hence the use of endswith
-        for attachment in QgsProject.instance().attachedFiles():
-            if attachment.endswith("layers.mldata"):
+        for attachment in proj.attachedFiles():
+            if attachment.endswith(MLDATA_ATTACHMENT):
+                self._cached_mldata_path = attachment
                 return attachment
 
         # The layers.mldata was not found in the attached files
         if fallback_to_legacy:
             return self.legacy_memory_layer_file()
 
+    def clear_mldata_path_cache(self):
+        """Forget the mldata attachment path, as the project attachments may have changed"""
+        self._cached_mldata_path = None
+
     def set_project_dirty(self):
         """Set project as dirty when a memory layer is modified"""
+        proj = QgsProject.instance()
+        if self.has_modified_layers and proj.isDirty():
+            return
         self.has_modified_layers = True
-        QgsProject.instance().setDirty(True)
+        proj.setDirty(True)
 
     def on_data_source_changed(self):
         # If a temporary layer is made permanent, its data source will change
@@ -185,14 +268,26 @@ class MemoryLayerSaver(LayerConnector):
 
     def show_info(self):
         """Display some information about the memory layers"""
-        layer_info = [(layer.name(), layer.featureCount()) for layer in self.memory_layers()]
+        is_saved_layer = Settings.is_saved_layer
+        layer_info = [
+            (layer.name(), layer.featureCount())
+            for layer in QgsProject.instance().mapLayers().values()
+            if is_saved_layer(layer)
+        ]
         if layer_info:
             message = self.tr("The following memory layers will be saved with this project:")
             message += "<br>"
-            message += "<br>".join(
-                self.tr("- <b>{0}</b> ({1} features)", "Layer name and number of features", n=count).format(name, count)
-                for name, count in layer_info
-            )
+            # The plural form depends on the count, so translate once per distinct count
+            line_formats = {}
+            lines = []
+            for name, count in layer_info:
+                line_format = line_formats.get(count)
+                if line_format is None:
+                    line_format = line_formats[count] = self.tr(
+                        "- <b>{0}</b> ({1} features)", "Layer name and number of features", n=count
+                    )
+                lines.append(line_format.format(name, count))
+            message += "<br>".join(lines)
         else:
             message = self.tr("This project contains no memory layers to be saved")
         QMessageBox.information(iface.mainWindow(), "Memory Layer Saver", message)
@@ -203,29 +298,21 @@ class MemoryLayerSaver(LayerConnector):
         bogus = QWidget(iface.mainWindow())
         bogus.setWindowIcon(QIcon(":/plugins/memory_layer_saver/icon.svg"))
 
-        # Get plugin metadata
-        cfg = configparser.ConfigParser()
-        cfg.read(Path(__file__).parent / "metadata.txt")
-
-        name = cfg.get("general", "name")
-        version = cfg.get("general", "version")
-        repository = cfg.get("general", "repository")
-        tracker = cfg.get("general", "tracker")
-        homepage = cfg.get("general", "homepage")
+        meta = self._meta
         QMessageBox.about(
             bogus,
-            self.tr("About {0}").format(name),
+            self.tr("About {0}").format(meta["name"]),
             "<b>Version</b> {}<br><br>"
             "<b>{}</b> : <a href={}>GitHub</a><br>"
             "<b>{}</b> : <a href={}/issues>GitHub</a><br>"
             "<b>{}</b> : <a href={}>GitHub</a>".format(
-                version,
+                meta["version"],
                 self.tr("Source code"),
-                repository,
+                meta["repository"],
                 self.tr("Report issues"),
-                tracker,
+                meta["tracker"],
                 self.tr("Documentation"),
-                homepage,
+                meta["homepage"],
             ),
         )
         bogus.deleteLater()
@@ -1,7 +1,7 @@
 from qgis.core import QgsFeature, QgsField, QgsGeometry
 from qgis.PyQt.QtCore import QDataStream, QFile, QIODevice
 
-from .toolbox import log
+from .toolbox import log, log_warning
 
 
 class Reader:
@@ -10,6 +10,8 @@ class Reader:
         self._file = None
         self._dstream = None
         self._version = None
+        # Layer id -> (offset, length) of the layer in the file (version >= 3)
+        self._offsets = None
 
     def __enter__(self):
         self.open()
@@ -29,9 +31,23 @@ class Reader:
             if ct != c:
                 raise ValueError(self._filename + " is not a valid memory layer data file")
         version = self._dstream.readInt32()
-        if version not in (1, 2):
+        if version not in (1, 2, 3):
             raise ValueError(self._filename + " is not compatible with this version of the MemoryLayerSaver plugin")
         self._version = version
+        self._offsets = None
+        if version > 2:
+            # Offset table, written by Writer.write_layers
+            self._offsets = {}
+            file_size = self._file.size()
+            for _i in range(self._dstream.readUInt32()):
+                layer_id = self._dstream.readQString()
+                offset = self._dstream.readUInt64()
+                length = self._dstream.readUInt64()
+                if self._dstream.status() != QDataStream.Ok:
+                    raise ValueError(self._filename + " is not a valid memory layer data file")
+                if offset + length > file_size:
+                    raise ValueError(self._filename + " is corrupted: cannot locate layer " + layer_id)
+                self._offsets[layer_id] = (offset, length)
 
     def close(self):
         try:
@@ -47,6 +63,18 @@ class Reader:
             raise ValueError("Layer stream not open for reading")
         ds = self._dstream
 
+        # Layers are located from the offset table
+        if self._offsets is not None:
+            layers_by_id = {layer.id(): layer for layer in layers}
+            for layer_id in sorted(self._offsets, key=self._offsets.get):
+                layer = layers_by_id.get(layer_id)
+                if layer is None:
+                    log(f"Unknown layer {layer_id} in project. Skipping.")
+                else:
+                    self.read_layer_at(layer)
+            return
+
+        # Legacy files: layers are read sequentially
         while True:
             if ds.atEnd():
                 return
@@ -62,12 +90,21 @@ class Reader:
             else:
                 self.read_layer(layer)
 
+    def read_layer_at(self, layer):
+        """Read a single layer, using the offset table to locate it"""
+        offset, length = self._offsets[layer.id()]
+        if not self._file.seek(offset) or self._dstream.readQString() != layer.id():
+            raise ValueError(self._filename + " is corrupted: cannot locate layer " + layer.id())
+        self.read_layer(layer)
+        if self._file.pos() != offset + length:
+            log_warning(f"Unexpected length of layer {layer.id()} in {self._filename}")
+
     def read_layer(self, layer):
         log("Reading layer " + layer.id())
         ds = self._dstream
         dp = layer.dataProvider()
         if dp.featureCount() > 0:
-            raise ValueError("Memory layer " + id + " is already loaded")
+            raise ValueError("Memory layer " + layer.id() + " is already loaded")
         attr = dp.attributeIndexes()
         dp.deleteAttributes(attr)
         ss = ""
@@ -11,6 +11,9 @@ SAVE_LAYER_KEY = "SaveMemoryProvider"
 # the settings dialog, to export a project that can be opened in older QGIS versions (< 3.22).
 MLDATA_EMBEDDED = "MemoryLayerSaver/mldataEmbedded"
 
+# Key of the memory data provider
+MEMORY_PROVIDER = "memory"
+
 
 class Settings:
     @classmethod
@@ -50,10 +53,18 @@ class Settings:
         return Qgis.QGIS_VERSION_INT < 32200 or not cls.mldata_embedded()
 
     @staticmethod
-    def is_saved_layer(layer):
+    def is_memory_layer(layer):
         if layer.type() != QgsMapLayer.VectorLayer:
-            return
-        data_provider = layer.dataProvider()
-        if data_provider is None or data_provider.name() != "memory":
             return False
+        data_provider = layer.dataProvider()
+        return data_provider is not None and data_provider.name() == MEMORY_PROVIDER
+
+    @staticmethod
+    def is_save_enabled(layer):
+        """Whether saving has not been disabled for this layer"""
         return layer.customProperty(SAVE_LAYER_KEY, True) in [True, "true", "True"]
+
+    @classmethod
+    def is_saved_layer(cls, layer):
+        # Only memory layers can be saved, reject the other providers first
+        return layer.providerType() == MEMORY_PROVIDER and cls.is_memory_layer(layer) and cls.is_save_enabled(layer)
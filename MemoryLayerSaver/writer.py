@@ -1,11 +1,22 @@
-from qgis.PyQt.QtCore import QDataStream, QFile, QIODevice
+import queue
+import threading
 
-from .toolbox import log
+from qgis.PyQt.QtCore import QDataStream, QIODevice, QObject, QSaveFile, pyqtSignal
+
+from .toolbox import log, log_error
+
+# Version of MLD format written by default. Version 2 (no offset table) can still be written
+# for projects that must be opened by older versions of the plugin.
+MLD_VERSION = 3
 
 
 class Writer:
-    def __init__(self, filename):
-        self._filename = filename
+    def __init__(self, device, version=MLD_VERSION):
+        """device is the QIODevice (e.g. a QBuffer) to write to"""
+        if version not in (2, 3):
+            raise ValueError(f"Cannot write version {version} of the memory layer data format")
+        self._version = version
+        self._device = device
         self._file = None
         self._dstream = None
 
@@ -14,18 +25,18 @@ class Writer:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close
+        self.close()
 
     def open(self):
-        self._file = QFile(self._filename)
-        if not self._file.open(QIODevice.WriteOnly):
-            raise ValueError("Cannot open " + self._filename)
+        self._file = self._device
+        if not self._file.isOpen() and not self._file.open(QIODevice.WriteOnly):
+            raise ValueError("Cannot open device for writing: " + self._file.errorString())
         self._dstream = QDataStream(self._file)
         self._dstream.setVersion(QDataStream.Qt_4_5)
         for c in b"QGis.MemoryLayerData":
             self._dstream.writeUInt8(c)
         # Version of MLD format
-        self._dstream.writeUInt32(2)
+        self._dstream.writeUInt32(self._version)
 
     def close(self):
         try:
@@ -36,14 +47,64 @@ class Writer:
         self._dstream = None
         self._file = None
 
+    @staticmethod
+    def write_file(filename, data):
+        """Write data (QByteArray) to filename
+
+        QSaveFile writes to a temporary file, then atomically replaces filename on commit,
+        so a failed write never leaves a truncated file behind.
+        """
+        file = QSaveFile(filename)
+        if not file.open(QIODevice.WriteOnly):
+            raise ValueError(f"Cannot open {filename}: {file.errorString()}")
+        if file.write(data) != data.size():
+            error = file.errorString()
+            file.cancelWriting()
+            raise ValueError(f"Cannot write {filename}: {error}")
+        if not file.commit():
+            raise ValueError(f"Cannot write {filename}: {file.errorString()}")
+
     def write_layers(self, layers):
+        if not self._dstream:
+            raise ValueError("Layer stream not open for writing")
+        # Version 2: layers are written sequentially
+        if self._version < 3:
+            for layer in layers:
+                self.write_layer(layer)
+            return
+
+        layers = list(layers)
+        ds = self._dstream
+        device = self._file
+
+        # Offset table: number of layers, then the id, offset and length of each layer
+        # The offsets are not known yet, so the table is rewritten once the layers are written
+        ds.writeUInt32(len(layers))
+        table_pos = device.pos()
+        self._write_offset_table([(layer.id(), 0, 0) for layer in layers])
+
+        entries = []
         for layer in layers:
+            offset = device.pos()
             self.write_layer(layer)
+            entries.append((layer.id(), offset, device.pos() - offset))
+
+        end_pos = device.pos()
+        device.seek(table_pos)
+        self._write_offset_table(entries)
+        device.seek(end_pos)
+
+    def _write_offset_table(self, entries):
+        ds = self._dstream
+        for layer_id, offset, length in entries:
+            ds.writeQString(layer_id)
+            ds.writeUInt64(offset)
+            ds.writeUInt64(length)
 
     def write_layer(self, layer):
         log("Writing layer " + layer.id())
         if not self._dstream:
-            raise ValueError("Layer stream not open for reading")
+            raise ValueError("Layer stream not open for writing")
         ds = self._dstream
         dp = layer.dataProvider()
         ss = layer.subsetString()
@@ -81,3 +142,57 @@ class Writer:
                 ds.writeRawData(wkb)
         ds.writeBool(False)
         layer.setSubsetString(ss)
+
+
+class FlushWorker(QObject):
+    """Write serialized mldata payloads to disk from a background thread
+
+    Each payload is written with Writer.write_file, which atomically replaces the file.
+    A thread is started when a payload is submitted and exits once all the payloads are written.
+    It is not a daemon thread, so pending payloads are still written if QGIS exits without unloading the plugin.
+    """
+
+    # Emitted with the filename and the error message when a payload cannot be written.
+    # Connect it with a queued connection, as it is emitted from the background thread.
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._queue = queue.Queue()
+        self._thread = None
+        # Protects _thread, so that a payload is never queued while the thread is exiting
+        self._lock = threading.Lock()
+
+    def submit(self, filename, payload):
+        """Queue payload (QByteArray) to be written to filename"""
+        with self._lock:
+            self._queue.put((filename, payload))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="MemoryLayerSaverFlush")
+                self._thread.start()
+
+    def wait(self):
+        """Block until all the submitted payloads are written"""
+        self._queue.join()
+
+    def stop(self):
+        """Wait for the remaining payloads to be written and the thread to exit"""
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._queue.empty():
+                    self._thread = None
+                    return
+                filename, payload = self._queue.get_nowait()
+            try:
+                Writer.write_file(filename, payload)
+            except BaseException as e:
+                log_error(str(e))
+                self.failed.emit(filename, str(e))
+            finally:
+                self._queue.task_done()